@@ -3,26 +3,106 @@
 Script for generating .pyi files for each CircuitPython board type.
 These files need to be bundled with the extension, meaning new boards require a new extension release.
 """
+import argparse
 import json
+import mmap
+import os
 import pathlib
 import re
-from functools import lru_cache
-from typing import Dict, List, Tuple
-from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import cache, partial
+from types import MappingProxyType
+from typing import Dict, Iterator, List, Mapping, Optional, Tuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import requests
 from bs4 import BeautifulSoup
 
+try:
+    import hyperscan
+except ImportError:  # optional, fall back to the re module
+    hyperscan = None
+
+try:
+    import orjson
+except ImportError:  # optional, fall back to the json module
+    orjson = None
+
+try:
+    import lxml  # noqa: F401 optional, C based parser for BeautifulSoup
+    _HTML_PARSER = "lxml"
+except ImportError:
+    _HTML_PARSER = "html.parser"
+
 # Constants
 URL = "https://circuitpython.org/downloads?sort-by=alpha-asc"
+CACHE_DIR = pathlib.Path(os.environ.get("XDG_CACHE_HOME") or pathlib.Path.home() / ".cache") / "vscode-circuitpython"
+MANUFACTURERS_CACHE = CACHE_DIR / "manufacturers.json"
 VID_PID_PATTERN = re.compile(r"0x[0-9A-Fa-f]{4}")
+# Byte patterns scanned over whole mmapped files, one definition per line
+_PIN_DEF_RE = re.compile(
+    rb"^[ \t\r\f\v]*{[ \t\r\f\v]*MP_ROM_QSTR\(MP_QSTR_(?P<name>[^\)\n]*)\)[ \t\r\f\v]*,"
+    rb"[ \t\r\f\v]*MP_ROM_PTR\((?P<value>[^\)\n]*)\)",
+    re.MULTILINE,
+)
+# mpconfigboard.mk settings read for each board, matched as "KEY = value # comment"
+_CFG_KEYS = (
+    "usb_vid",
+    "usb_pid",
+    "usb_product",
+    "usb_manufacturer",
+    "circuitpy_creator_id",
+    "circuitpy_creation_id",
+)
+_CFG_RE = re.compile(
+    rb"^(" + rb"|".join(key.upper().encode() for key in _CFG_KEYS) + rb")[ \t]*[?:]?=[ \t]*([^#\n]*)",
+    re.MULTILINE,
+)
+_DEF_RE = re.compile(r"def ([^\(]*)\(.*")
+_MFR_TOKEN_RE = re.compile(r"[\s_]+")
+
+# Pin values with a known type -> (module to import, type annotation)
+_PIN_VALUE_TYPES = {
+    "&displays[0].epaper_display": ("displayio", "displayio.EPaperDisplay"),
+    "&displays[0].display": ("displayio", "displayio.Display"),
+}
+
+# Generic board stub name -> (stub source, whether it needs "import busio")
+GenericStubs = Mapping[str, Tuple[str, bool]]
 
-def fetch_sorted_manufacturers(url: str) -> List[Dict[str, str]]:
-    """Fetch and return a sorted list of manufacturers and names from the webpage."""
+def _load_manufacturers_cache() -> Dict[str, Dict]:
+    """Return the cached downloads page results, keyed by URL."""
+    try:
+        with MANUFACTURERS_CACHE.open() as cache_file:
+            return json.load(cache_file).get("pages", {})
+    except (OSError, ValueError, AttributeError):
+        return {}
+
+def _save_manufacturers_cache(pages: Dict[str, Dict]) -> None:
+    """Persist the parsed downloads pages along with their ETags."""
+    try:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        with MANUFACTURERS_CACHE.open("w") as cache_file:
+            json.dump({"pages": pages}, cache_file)
+    except OSError as e:
+        print(f"Error writing {MANUFACTURERS_CACHE}: {e}")
+
+def _fetch_manufacturers_page(url: str, cached: Optional[Dict]) -> Optional[Dict]:
+    """Fetch and parse one downloads page, revalidating the cached copy.
+
+    Returns {"etag": ..., "manufacturers": [...]}, the cached entry itself
+    when the page is unchanged or unreachable, or None on error.
+    """
+    # An entry without the parsed page is no use, even when its ETag matches
+    if not (isinstance(cached, dict) and isinstance(cached.get("manufacturers"), list)):
+        cached = None
+    headers = {"If-None-Match": cached["etag"]} if cached and cached.get("etag") else {}
     try:
         with requests.Session() as session:
-            response = session.get(url)
+            response = session.get(url, headers=headers)
+            if response.status_code == 304 and cached:
+                return cached
             response.raise_for_status()
-            soup = BeautifulSoup(response.text, "html.parser")
+            soup = BeautifulSoup(response.text, _HTML_PARSER)
             elements = soup.find_all("div", class_="download")
             data_list = [
                 {
@@ -32,177 +112,320 @@ def fetch_sorted_manufacturers(url: str) -> List[Dict[str, str]]:
                 for element in elements
                 if element.get("data-name") and element.get("data-manufacturer")
             ]
-            return sorted(data_list, key=lambda x: x["name"].lower())
+            return {"etag": response.headers.get("ETag"), "manufacturers": data_list}
     except requests.RequestException as e:
         print(f"Error fetching data: {e}")
-        return []
-
-def parse_generic_stub(board_stub: pathlib.Path) -> Dict[str, str]:
-    """Parse the generic board stub file."""
-    generic_stubs = {}
-    def_re = re.compile(r"def ([^\(]*)\(.*")
-    with board_stub.open('r') as stub:
-        stubs = stub.readlines()
-        # Find the first line number and name of each definition
-        f = []
-        names = []
-        for i, s in enumerate(stubs):
-            match = def_re.match(s)
-            if match is not None:
-                f.append(i)
-                names.append(match[1])
-        f.append(len(stubs))
-        # Iterate the line ranges
-        for name, start, end in zip(names, f, f[1:]):
-            generic_stubs[name] = "".join(stubs[start:end])
-    return generic_stubs
+        if cached:
+            print(f"Using cached manufacturers for {url} from {MANUFACTURERS_CACHE}")
+            return cached
+        return None
+
+def fetch_sorted_manufacturers(*urls: str) -> List[Dict[str, str]]:
+    """Fetch and return a sorted list of manufacturers and names from the webpages.
+
+    Results are cached on disk and revalidated with If-None-Match, so an
+    unchanged page is neither downloaded nor parsed again. Several pages are
+    fetched concurrently, so the wait is bound by the slowest one.
+    """
+    cached_pages = _load_manufacturers_cache()
+    def fetch(url: str) -> Optional[Dict]:
+        return _fetch_manufacturers_page(url, cached_pages.get(url))
+    if len(urls) == 1:
+        pages = [fetch(urls[0])]
+    else:
+        with ThreadPoolExecutor(max_workers=len(urls)) as executor:
+            pages = list(executor.map(fetch, urls))
+    fetched = {url: page for url, page in zip(urls, pages) if page is not None}
+    if any(page is not cached_pages.get(url) for url, page in fetched.items()):
+        cached_pages.update(fetched)
+        _save_manufacturers_cache(cached_pages)
+    data_list = [data for page in fetched.values() for data in page["manufacturers"]]
+    return sorted(data_list, key=lambda x: x["name"].lower())
+
+def build_manufacturer_index(sorted_manufacturers: List[Dict[str, str]]) -> Dict[str, Dict[str, str]]:
+    """Index manufacturers by lowercased name and by each name token, first entry wins."""
+    by_name = {}
+    by_token = {}
+    for data in sorted_manufacturers:
+        manufacturer = data["manufacturer"]
+        name_lc = manufacturer.lower()
+        by_name.setdefault(name_lc, manufacturer)
+        for token in _MFR_TOKEN_RE.split(name_lc):
+            if token:
+                by_token.setdefault(token, manufacturer)
+    return {"by_name": by_name, "by_token": by_token}
+
+def match_manufacturer(manufacturer_index: Dict[str, Dict[str, str]], prefix_lc: str) -> Optional[str]:
+    """Return the manufacturer whose name contains the lowercased board prefix, if any."""
+    by_name = manufacturer_index["by_name"]
+    matched = manufacturer_index["by_token"].get(prefix_lc) or by_name.get(prefix_lc)
+    if matched is None:
+        # Substring fallback, only over the distinct manufacturer names
+        matched = next((m for name_lc, m in by_name.items() if prefix_lc in name_lc), None)
+    return matched
+
+@cache
+def parse_generic_stub(board_stub: pathlib.Path) -> GenericStubs:
+    """Parse the generic board stub file.
+
+    Maps each definition name to its source and whether it needs busio.
+    The result is cached per path, so it is returned as a read only mapping.
+    """
+    definitions = {}
+    if _HS_DB is not None:
+        # Scan the whole stub once; each definition runs up to the next one
+        data = board_stub.read_text().encode()
+        spans = _hs_scan(data, _HS_DEF_ID)
+        ends = [start for start, _ in spans[1:]] + [len(data)]
+        for (start, end), stop in zip(spans, ends):
+            name = data[start + len("def "):end - 1].decode()
+            definitions[name] = data[start:stop].decode()
+    else:
+        with board_stub.open('r') as stub:
+            stubs = stub.readlines()
+            # Find the first line number and name of each definition
+            f = []
+            names = []
+            for i, s in enumerate(stubs):
+                match = _DEF_RE.match(s)
+                if match is not None:
+                    f.append(i)
+                    names.append(match[1])
+            f.append(len(stubs))
+            # Iterate the line ranges
+            for name, start, end in zip(names, f, f[1:]):
+                definitions[name] = "".join(stubs[start:end])
+    return MappingProxyType({name: (body, "busio" in body) for name, body in definitions.items()})
 
 def normalize_vid_pid(value: str) -> str:
     """Normalize VID/PID to format 0x04D8 (lowercase 'x', uppercase hex digits)."""
     if not value:
         return value
-    if value.startswith("0x") or value.startswith("0X"):
-        # Ensure '0x' prefix and uppercase hex digits
-        return f"0x{value[2:].upper()}"
-    # For values without '0x' prefix
-    return f"0x{value.zfill(4).upper()}"
+    digits = value[2:] if value[:2] in ("0x", "0X") else value
+    try:
+        # Pad to at least 4 digits, keeping wider values (creator IDs) as written
+        return f"0x{int(digits, 16):0{max(4, len(digits))}X}"
+    except ValueError:
+        # Not a hex literal (e.g. a make variable), keep it as written
+        return value
 
-_PIN_DEF_RE = re.compile(
-    r"\s*{\s*MP_ROM_QSTR\(MP_QSTR_(?P<name>[^\)]*)\)\s*,\s*MP_ROM_PTR\((?P<value>[^\)]*)\).*"
+# Capture-free forms of the pin and stub definition patterns. Hyperscan
+# only reports match offsets, the captures are then extracted by running
+# the re pattern at the match start.
+_HS_PIN_ID = 0
+_HS_DEF_ID = 1
+_HS_PATTERNS = (
+    (rb"^[ \t\r\f\v]*\{[ \t\r\f\v]*MP_ROM_QSTR\(MP_QSTR_[^)\n]*\)[ \t\r\f\v]*,"
+     rb"[ \t\r\f\v]*MP_ROM_PTR\([^)\n]*\)", _HS_PIN_ID),
+    (rb"^def [^(\n]*\(", _HS_DEF_ID),
 )
 
-def parse_pins(generic_stubs: Dict[str, str], pins: pathlib.Path, board_stubs: Dict[str, str]) -> Tuple[str, str]:
+def _build_hs_database():
+    """Compile all patterns into a single block mode Hyperscan database."""
+    expressions, ids = zip(*_HS_PATTERNS)
+    db = hyperscan.Database(mode=hyperscan.HS_MODE_BLOCK)
+    db.compile(
+        expressions=list(expressions),
+        ids=list(ids),
+        elements=len(ids),
+        flags=[hyperscan.HS_FLAG_MULTILINE | hyperscan.HS_FLAG_SOM_LEFTMOST] * len(ids),
+    )
+    return db
+
+_HS_DB = _build_hs_database() if hyperscan is not None else None
+
+def _hs_scan(data, pattern_id: int) -> List[Tuple[int, int]]:
+    """Return the (start, end) offsets of every match of pattern_id in data."""
+    spans = []
+    def on_match(match_id, start, end, flags, context):
+        if match_id == pattern_id:
+            spans.append((start, end))
+    _HS_DB.scan(data, match_event_handler=on_match)
+    return spans
+
+@contextmanager
+def _mapped(path: pathlib.Path) -> Iterator[bytes]:
+    """Map a file read only, empty files (which mmap rejects) yield b''."""
+    with path.open('rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            yield b""
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            yield buf
+
+def _iter_pin_defs(pins: pathlib.Path) -> Iterator[Tuple[str, str]]:
+    """Yield the (name, value) of every pin definition in the pins file."""
+    with _mapped(pins) as buf:
+        if _HS_DB is None:
+            matches = _PIN_DEF_RE.finditer(buf)
+        else:
+            matches = (_PIN_DEF_RE.match(buf, start) for start, _ in _hs_scan(buf, _HS_PIN_ID))
+        for pin in matches:
+            yield pin.group("name").decode(), pin.group("value").decode()
+
+def parse_pins(generic_stubs: GenericStubs, pins: pathlib.Path, board_stubs: Dict[str, str]) -> Tuple[str, str]:
     """Parse the pins file and generate imports and stub lines."""
     imports = set()
     stub_lines = []
-    with pins.open('r') as p:
-        try:
-            for line in p:
-                pin = _PIN_DEF_RE.match(line)
-                if pin is None:
-                    continue
-                pin_name = pin.group("name")
-                if pin_name in generic_stubs:
-                    board_stubs[pin_name] = generic_stubs[pin_name]
-                    if "busio" in generic_stubs[pin_name]:
-                        imports.add("busio")
-                    continue
-                pin_type = None
-                pin_value = pin.group("value")
-                if pin_value == "&displays[0].epaper_display":
-                    imports.add("displayio")
-                    pin_type = "displayio.EPaperDisplay"
-                elif pin_value == "&displays[0].display":
-                    imports.add("displayio")
-                    pin_type = "displayio.Display"
-                elif pin_value.startswith("&pin_"):
-                    imports.add("microcontroller")
-                    pin_type = "microcontroller.Pin"
-                if pin_type is None:
-                    imports.add("typing")
-                    pin_type = "typing.Any"
-                stub_lines.append(f"{pin_name}: {pin_type} = ...\n")
-        except Exception as e:
-            print(f"Error processing pins in {pins}: {e}")
+    try:
+        for pin_name, pin_value in _iter_pin_defs(pins):
+            generic_stub = generic_stubs.get(pin_name)
+            if generic_stub is not None:
+                board_stubs[pin_name], uses_busio = generic_stub
+                if uses_busio:
+                    imports.add("busio")
+                continue
+            literal = _PIN_VALUE_TYPES.get(pin_value)
+            if literal is not None:
+                module, pin_type = literal
+            elif pin_value.startswith("&pin_"):
+                module, pin_type = "microcontroller", "microcontroller.Pin"
+            else:
+                module, pin_type = "typing", "typing.Any"
+            imports.add(module)
+            stub_lines.append(f"{pin_name}: {pin_type} = ...\n")
+    except Exception as e:
+        print(f"Error processing pins in {pins}: {e}")
     return '\n'.join(f"import {x}" for x in sorted(imports)) + '\n', ''.join(stub_lines)
 
-def process_boards(repo_root: pathlib.Path, circuitpy_repo_root: pathlib.Path, generic_stubs: Dict[str, str]) -> List[Dict[str, str]]:
+def iter_board_configs(circuitpy_repo_root: pathlib.Path) -> Iterator[str]:
+    """Yield the path of every ports/*/boards/*/mpconfigboard.mk.
+
+    os.scandir reuses the type information from the directory listing,
+    where Path.glob builds a Path and stats each entry.
+    """
+    with os.scandir(circuitpy_repo_root / "ports") as ports:
+        for port in ports:
+            if not port.is_dir():
+                continue
+            boards_dir = os.path.join(port.path, "boards")
+            if not os.path.isdir(boards_dir):
+                continue
+            with os.scandir(boards_dir) as boards:
+                for b in boards:
+                    config_path = os.path.join(b.path, "mpconfigboard.mk")
+                    if b.is_dir() and os.path.isfile(config_path):
+                        yield config_path
+
+def process_board(config_path: str, generic_stubs: GenericStubs,
+                  manufacturer_index: Dict[str, Dict[str, str]]) -> Optional[Tuple[Dict[str, str], str, str, Dict[str, str]]]:
+    """Parse a single board configuration and its pins file.
+
+    Runs in a worker process, so it only takes and returns picklable values.
+    Returns the board metadata, imports, pin stubs and generic board stubs,
+    or None if the board is skipped.
+    """
+    config = pathlib.Path(config_path)
+    b = config.parent
+    site_path = b.stem
+    pins = b / "pins.c"
+    pins_csv = b / "pins.csv"
+    # Skip if config file is missing
+    if not config.is_file():
+        print(f"Skipping {site_path}: mpconfigboard.mk not found")
+        return None
+    # Skip if using pins.csv instead of pins.c
+    if pins_csv.exists() and not pins.exists():
+        print(f"Skipping {site_path}: using pins.csv instead of pins.c")
+        return None
+    # Skip if neither pins.c nor pins.csv exists
+    if not pins.exists() and not pins_csv.exists():
+        print(f"Skipping {site_path}: no pins file found")
+        return None
+    board_info = dict.fromkeys(_CFG_KEYS, "")
+    with _mapped(config) as conf:
+        for setting in _CFG_RE.finditer(conf):
+            board_info[setting.group(1).decode().lower()] = setting.group(2).strip(b'" \r\n').decode()
+    # Fallback logic
+    if not board_info["usb_vid"] and board_info["circuitpy_creator_id"]:
+        board_info["usb_vid"] = board_info["circuitpy_creator_id"]
+    if not board_info["usb_pid"] and board_info["circuitpy_creation_id"]:
+        board_info["usb_pid"] = board_info["circuitpy_creation_id"]
+    prefix = site_path.split("_", 1)[0]
+    prefix_cap = prefix.capitalize()
+    prefix_lc = prefix.lower()
+    mfr_lc = board_info["usb_manufacturer"].lower()
+    matched_manufacturer = match_manufacturer(manufacturer_index, prefix_lc)
+    if (matched_manufacturer == "Unknown" or (matched_manufacturer and prefix_lc not in mfr_lc)
+            or not board_info["usb_product"] or not board_info["usb_manufacturer"]):
+        board_info["usb_product"] = site_path
+        board_info["usb_manufacturer"] = prefix_cap
+    board_info["usb_vid"] = normalize_vid_pid(board_info["usb_vid"])
+    board_info["usb_pid"] = normalize_vid_pid(board_info["usb_pid"])
+    board = {
+        "vid": board_info["usb_vid"],
+        "pid": board_info["usb_pid"],
+        "product": board_info["usb_product"],
+        "manufacturer": board_info["usb_manufacturer"],
+        "site_path": site_path,
+        "description": f"{board_info['usb_manufacturer']} {board_info['usb_product']}",
+    }
+    board_stubs = {}
+    imports_string, stubs_string = parse_pins(generic_stubs, pins, board_stubs)
+    return board, imports_string, stubs_string, board_stubs
+
+def process_boards(repo_root: pathlib.Path, circuitpy_repo_root: pathlib.Path, generic_stubs: GenericStubs) -> List[Dict[str, str]]:
     """Process all board configurations."""
     boards = []
     processed_boards = {}
-    sorted_manufacturers = fetch_sorted_manufacturers(URL)
-    board_configs = circuitpy_repo_root.glob("ports/*/boards/*/mpconfigboard.mk")
-    for config in board_configs:
-        b = config.parent
-        site_path = b.stem
-        pins = b / "pins.c"
-        pins_csv = b / "pins.csv"
-        # Skip if config file is missing
-        if not config.is_file():
-            print(f"Skipping {site_path}: mpconfigboard.mk not found")
-            continue
-        # Skip if using pins.csv instead of pins.c
-        if pins_csv.exists() and not pins.exists():
-            print(f"Skipping {site_path}: using pins.csv instead of pins.c")
-            continue
-        # Skip if neither pins.c nor pins.csv exists
-        if not pins.exists() and not pins_csv.exists():
-            print(f"Skipping {site_path}: no pins file found")
-            continue
-        board_info = {
-            "usb_vid": "",
-            "usb_pid": "",
-            "usb_product": "",
-            "usb_manufacturer": "",
-            "circuitpy_creator_id": "",
-            "circuitpy_creation_id": "",
-        }
-        with config.open() as conf:
-            for line in conf:
-                for key in board_info:
-                    if line.startswith(key.upper()):
-                        board_info[key] = line.split("=")[1].split("#")[0].strip('" \n')
-        # Fallback logic
-        if not board_info["usb_vid"] and board_info["circuitpy_creator_id"]:
-            board_info["usb_vid"] = board_info["circuitpy_creator_id"]
-        if not board_info["usb_pid"] and board_info["circuitpy_creation_id"]:
-            board_info["usb_pid"] = board_info["circuitpy_creation_id"]
-        prefix = site_path.split("_", 1)[0]
-        matched_manufacturer = next(
-            (data["manufacturer"] for data in sorted_manufacturers if prefix.lower() in data["manufacturer"].lower()),
-            None
-        )
-        if matched_manufacturer == "Unknown" or (matched_manufacturer and prefix.lower() not in board_info["usb_manufacturer"].lower()):
-            board_info["usb_product"] = site_path
-            board_info["usb_manufacturer"] = prefix.capitalize()
-        if not board_info["usb_product"] or not board_info["usb_manufacturer"]:
-            board_info["usb_product"] = site_path
-            board_info["usb_manufacturer"] = prefix.capitalize()
-        board_info["usb_vid"] = normalize_vid_pid(board_info["usb_vid"])
-        board_info["usb_pid"] = normalize_vid_pid(board_info["usb_pid"])
-        board_id = f"{board_info['usb_vid']}:{board_info['usb_pid']}"
-        if board_id in processed_boards:
-            processed_boards[board_id] += 1
-            print(f"Note: Found another board with the same VID:PID: {board_id}:{site_path}")
-        else:
-            processed_boards[board_id] = 0
-        board = {
-            "vid": board_info["usb_vid"],
-            "pid": board_info["usb_pid"],
-            "product": board_info["usb_product"],
-            "manufacturer": board_info["usb_manufacturer"],
-            "site_path": site_path,
-            "description": f"{board_info['usb_manufacturer']} {board_info['usb_product']}",
-        }
-        boards.append(board)
-        board_pyi_path = repo_root / "boards" / board_info["usb_vid"] / board_info["usb_pid"]
+    manufacturer_index = build_manufacturer_index(fetch_sorted_manufacturers(URL))
+    board_configs = list(iter_board_configs(circuitpy_repo_root))
+    # mappingproxy can't be pickled, workers get a plain copy
+    worker = partial(process_board, generic_stubs=dict(generic_stubs), manufacturer_index=manufacturer_index)
+    # Parsing is pure Python and GIL bound, so spread it over processes.
+    # Results come back in config order, so boards sharing a VID:PID keep
+    # overwriting each other deterministically.
+    board_files = {}
+    # The default worker count is the CPU count, capped at 61 on Windows
+    with ProcessPoolExecutor() as executor:
+        for result in executor.map(worker, board_configs, chunksize=16):
+            if result is None:
+                continue
+            board, imports_string, stubs_string, board_stubs = result
+            board_id = f"{board['vid']}:{board['pid']}"
+            if board_id in processed_boards:
+                processed_boards[board_id] += 1
+                print(f"Note: Found another board with the same VID:PID: {board_id}:{board['site_path']}")
+            else:
+                processed_boards[board_id] = 0
+            boards.append(board)
+            # Always use 'board.pyi' as the file name
+            board_pyi_file = repo_root / "boards" / board["vid"] / board["pid"] / "board.pyi"
+            parts = [
+                "from __future__ import annotations\n",
+                imports_string,
+                f'"""\nboard {board["description"]}\n',
+                f'https://circuitpython.org/boards/{board["site_path"]}\n"""\n',
+                stubs_string,
+                *(f"{stub}\n" for stub in board_stubs.values()),
+            ]
+            board_files[board_pyi_file] = "".join(parts)
+    # One mkdir per distinct VID/PID directory, then one write per file
+    for board_pyi_path in {board_pyi_file.parent for board_pyi_file in board_files}:
         board_pyi_path.mkdir(parents=True, exist_ok=True)
-        
-        # Always use 'board.pyi' as the file name
-        board_pyi_file = board_pyi_path / "board.pyi"
-        
-        board_stubs = {}
-        imports_string, stubs_string = parse_pins(generic_stubs, pins, board_stubs)
-        with board_pyi_file.open("w") as outfile:
-            outfile.write("from __future__ import annotations\n")
-            outfile.write(imports_string)
-            outfile.write(f'"""\nboard {board["description"]}\n')
-            outfile.write(f'https://circuitpython.org/boards/{board["site_path"]}\n"""\n')
-            outfile.write(stubs_string)
-            for p in board_stubs:
-                outfile.write(f"{board_stubs[p]}\n")
+    for board_pyi_file, contents in board_files.items():
+        board_pyi_file.write_text(contents)
     return boards
 
 def main():
     """Main function to generate board stubs and metadata."""
     repo_root = pathlib.Path(__file__).resolve().parent.parent
+    parser = argparse.ArgumentParser(description="Generate board stubs and metadata.")
+    # build-stubs.py may check circuitpython out elsewhere, e.g. on tmpfs
+    parser.add_argument("--circuitpython_dir", type=pathlib.Path, default=repo_root / "circuitpython",
+                        help="circuitpython checkout to read the boards from")
+    args = parser.parse_args()
     board_stub = repo_root / "stubs" / "board" / "__init__.pyi"
     generic_stubs = parse_generic_stub(board_stub)
-    circuitpy_repo_root = repo_root / "circuitpython"
+    circuitpy_repo_root = args.circuitpython_dir.resolve()
     boards = process_boards(repo_root, circuitpy_repo_root, generic_stubs)
     json_file = repo_root / "boards" / "metadata.json"
-    with json_file.open("w") as metadata_file:
-        json.dump(boards, metadata_file, indent=4)
+    if orjson is not None:
+        json_file.write_bytes(orjson.dumps(boards, option=orjson.OPT_INDENT_2))
+    else:
+        # Same output as orjson: two space indent, UTF-8 rather than \u escapes
+        with json_file.open("w", encoding="utf-8") as metadata_file:
+            json.dump(boards, metadata_file, indent=2, ensure_ascii=False)
 
 if __name__ == "__main__":
     main()
@@ -5,15 +5,32 @@ Handles repository cloning, stub generation, and virtual environment management.
 """
 from __future__ import annotations  
 import argparse
+import errno
+import hashlib
 import logging
 import os
+import shlex
 import shutil
+import signal
 import subprocess
 import sys
 import re
+import tarfile
+import tempfile
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Optional, TypeVar, Callable, Any,ClassVar, TypedDict
 
+try:
+    from packaging.version import Version
+except ImportError:  # optional, fall back to comparing (major, minor, patch)
+    Version = None
+
+# the stubs released on PyPI are built from this repo
+_UPSTREAM_REPO_URL = "https://github.com/adafruit/circuitpython.git"
+
 # Configuration
 #def configOption
 #CIRCUITPYTHON_VERSION = "9.2.8"
@@ -21,45 +38,129 @@ class StubsConfig:
     PYTHON_COMMAND="python3.12" 
     CIRCUITPYTHON_VERSION = "9.2.9"
     DEBUG:bool = True
-    CIRCUITPYTHON_REPO_URL = "https://github.com/adafruit/circuitpython.git"
+    FULL_HISTORY:bool = False # full clone for bisect/merge-base instead of a shallow one
+    FORCE:bool = False # rebuild even if the stubs are already built for the version
+    BUILD_FROM_SOURCE:bool = False # make stubs instead of downloading the released circuitpython-stubs from PyPI
+    PARTIAL:bool = False # partial clone, blobs are downloaded when the checkout needs them
+    TMPFS:bool = False # check circuitpython out on /dev/shm (Linux), it is lost on reboot
+    USE_MIRROR:bool = False # check versions out as worktrees of a bare mirror kept in the user cache
+    NETWORK_TIMEOUT = "1800" # seconds before a hung clone/fetch/pip install is stopped, 0 for no limit
+    CIRCUITPYTHON_REPO_URL = _UPSTREAM_REPO_URL
     #CIRCUITPYTHON_REPO_URL = "https://github.com/jbrelwof/circuitpython.git"
 
+CACHE_DIR = Path(os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache") / "vscode-circuitpython"
+
+# circuitpython requirements installed into the stubs venv
+_VENV_REQUIREMENTS = ("requirements-doc.txt", "requirements-dev.txt")
+_VERSION_RE = re.compile(r"^(?:\w+\s+)?(?:v)?(?P<version>(\d+)\.(\d+)\.(\d+)\S*)$")
+_TMPFS_ROOT = Path("/dev/shm")
+# circuitpython with its submodules and a stubs build
+_TMPFS_MIN_FREE = 4 * 1024**3
 
 
 def safe_rmtree(path: Path) -> None:
     """
     Safely remove a directory tree.
+    On POSIX rm -rf does it, much faster than shutil.rmtree for trees
+    with thousands of files such as the venv.
     
     Args:
         path: Path to remove
     """
+    rm = shutil.which("rm") if os.name == "posix" else None
+    if rm:
+        result = subprocess.run([rm, "-rf", "--", str(path)], stderr=subprocess.PIPE, text=True)
+        if result.returncode != 0:
+            logging.error(f"Error removing {path}: {result.stderr.strip()}")
+        return
     try:
         shutil.rmtree(path)
     except OSError as e:
         logging.error(f"Error removing {path}: {e}")
 
+def tmpfs_checkout_dir() -> Optional[Path]:
+    """
+    Directory on tmpfs for the circuitpython checkout. The name is fixed, so
+    each build step finds the checkout of the previous one.
+
+    Returns:
+        None when there is no usable tmpfs (not Linux, less than 4 GiB free,
+        or the directory belongs to another user)
+    """
+    if not sys.platform.startswith("linux") or not _TMPFS_ROOT.is_dir():
+        return None
+    path = _TMPFS_ROOT / f"vscode-circuitpython-{os.getuid()}" / "circuitpython"
+    path.parent.mkdir(mode=0o700, exist_ok=True)
+    if path.parent.stat().st_uid != os.getuid():
+        logging.warning(f"{path.parent} belongs to another user, not using tmpfs")
+        return None
+    if not path.exists() and shutil.disk_usage(_TMPFS_ROOT).free < _TMPFS_MIN_FREE:
+        logging.warning(f"Less than {_TMPFS_MIN_FREE // 1024**3} GiB free on {_TMPFS_ROOT}, not using tmpfs")
+        return None
+    return path
+
+def extract_stubs_wheel(wheel: Path, dest: Path) -> None:
+    """
+    Unpack a circuitpython-stubs wheel into dest, laid out like the make stubs
+    output: the <module>-stubs packages lose their suffix, the dist-info is left out.
+    """
+    with zipfile.ZipFile(wheel) as whl:
+        for info in whl.infolist():
+            parts = info.filename.split("/")
+            if len(parts) < 2 or parts[0].endswith(".dist-info") or ".." in parts or info.is_dir():
+                continue
+            parts[0] = parts[0].removesuffix("-stubs")
+            target = dest.joinpath(*parts)
+            target.parent.mkdir(parents=True, exist_ok=True)
+            with whl.open(info) as src, open(target, "wb") as dst:
+                shutil.copyfileobj(src, dst)
+
+def move_or_copy(src: Path | os.DirEntry[str], dst: Path) -> None:
+    """
+    Move a file or directory tree by renaming it, which moves no data.
+    Across filesystems, where rename fails with EXDEV, copy it instead
+    (a hard link would fail the same way).
+    A DirEntry from os.scandir answers is_dir() without another stat.
+    """
+    try:
+        os.rename(src, dst)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        if src.is_dir():
+            shutil.copytree(src, dst)
+        else:
+            shutil.copy2(src, dst)
+
 class StubEntry:
-    def __init__(self, method: Callable[..., Any], inCP: bool = True, unique: bool = False):
+    def __init__(self, method: Callable[..., Any], inCP: bool = True, unique: bool = False,
+                 concurrent: bool = False, fromSource: bool = False):
         self.method = method
         self.inCP = inCP
         self.unique = unique
+        # all runs it in the background alongside the next target
+        self.concurrent = concurrent
+        # only needed to build the stubs from source, all skips it when the stubs are there without building them
+        self.fromSource = fromSource
         
     targets:ClassVar[dict[str,StubEntry]] = {}
     targetsInOrder:ClassVar[list[StubEntry]] = []
 
     def __call__( self, generator: 'StubGenerator') -> None:
+        # Targets pass cwd to each command instead of changing directory,
+        # so targets can run concurrently
         if self.inCP:
             assert os.path.exists(generator.circuitpython_dir), "CircuitPython directory does not exist."
-            os.chdir(generator.circuitpython_dir)
+            cwd = generator.circuitpython_dir
         else:
-            os.chdir(generator.repo_root)
-        print(f"Running {self.method.__name__} in {os.getcwd()}")
+            cwd = generator.repo_root
+        print(f"Running {self.method.__name__} in {cwd}")
         self.method(generator)
         
 
-def stubTarget( inCP:bool = True, unique:bool=False  ) :
+def stubTarget( inCP:bool = True, unique:bool=False, concurrent:bool=False, fromSource:bool=False ) :
     def decorate( func: Callable[..., Any] ) -> Callable[..., Any]:
-        entry = StubEntry(func, inCP, unique)
+        entry = StubEntry(func, inCP, unique, concurrent, fromSource)
         StubEntry.targets[func.__name__] = entry
         if not unique:
             StubEntry.targetsInOrder.append(entry)
@@ -80,18 +181,25 @@ class StubGenerator:
         # Setup paths
         self.script_dir = Path(__file__).parent.absolute()
         self.repo_root = self.script_dir.parent
-        self.circuitpython_dir = self.repo_root / "circuitpython"
-        self.venv_dir = self.circuitpython_dir / ".venv"
+        self.circuitpython_dir = (StubsConfig.TMPFS and tmpfs_checkout_dir()) or self.repo_root / "circuitpython"
+        # shared by all checkouts when USE_MIRROR is set
+        self.mirror_dir = CACHE_DIR / "circuitpython.git"
+        # Kept outside the clone so it survives re-cloning
+        self.venv_dir = self.repo_root / ".venv-stubs"
+        # hash of the requirements the venv was last installed from
+        self.venv_reqs_file = self.venv_dir / ".reqs.sha"
         self.stubs_dir = self.repo_root / "stubs"
         self.circuitpython_stubs = self.circuitpython_dir / "circuitpython-stubs"
+        # circuitpython commit the current stubs are for and where they came from ("source" or "pypi")
+        self.stubs_version_file = self.stubs_dir / ".version"
 
-        # Change to repo root
-        os.chdir(self.repo_root)
         if os.path.exists(self.venv_dir):
             self._setupVenvCmds()
-            
-        if os.path.exists(self.circuitpython_dir):
-            os.chdir(self.circuitpython_dir)        
+
+        # Commands still running, so a failing target can stop the concurrent ones
+        self._processes: set[subprocess.Popen] = set()
+        self._processes_lock = threading.Lock()
+        self._stopping = False
 
     def build(self, target: str) -> None:
         if target not in StubEntry.targets:
@@ -99,100 +207,381 @@ class StubGenerator:
             sys.exit(1)
         StubEntry.targets[target](self)
 
-    @stubTarget( unique=True )
+    @stubTarget( inCP=False, unique=True )
     def all(self):
-        for target in StubEntry.targetsInOrder:
-            target(self)
+        # A concurrent target overlaps with the target after it, e.g. the
+        # submodule fetch runs while the venv is set up
+        stubs_ready = None
+        with ThreadPoolExecutor() as executor:
+            background = []
+            try:
+                for target in StubEntry.targetsInOrder:
+                    if target.fromSource:
+                        # Decided once the checkout is there. The other targets
+                        # still run, so boards are built even when the stubs are not.
+                        if stubs_ready is None:
+                            stubs_ready = self._stubsReady()
+                        if stubs_ready:
+                            continue
+                    if target.concurrent:
+                        background.append(executor.submit(target, self))
+                        continue
+                    target(self)
+                    for future in background:
+                        future.result()
+                    background.clear()
+            except BaseException:
+                # Don't wait for e.g. the submodule fetch before exiting,
+                # including after Ctrl-C, which only reaches this process
+                if background:
+                    self._stopCommands()
+                raise
+
+    def _stopCommands(self) -> None:
+        """Stop the commands that are still running and refuse to start new ones."""
+        with self._processes_lock:
+            self._stopping = True
+            processes = list(self._processes)
+        for process in processes:
+            self._terminate(process)
+
+    def _stubsReady(self) -> bool:
+        """Put stubs for the checkout in stubs_dir without building them, False if they have to be built."""
+        if not StubsConfig.FORCE and self._stubsUpToDate():
+            print(f"Stubs are already built for {self.version}, use --force to rebuild")
+            return True
+        # Checked before the submodules are fetched, the key only needs the checkout
+        if not StubsConfig.FORCE and self._unpackCachedStubs():
+            return True
+        # Released stubs are on PyPI, the source build is the fallback
+        if StubsConfig.BUILD_FROM_SOURCE:
+            print("Building stubs from source (--build_from_source)")
+            return False
+        if not self._isUpstreamRepo():
+            print(f"Building stubs from source, {StubsConfig.CIRCUITPYTHON_REPO_URL} is not the upstream repo")
+            return False
+        print(f"Using the released stubs for {self.version} from PyPI")
+        return self._fetchStubs()
+
+    @staticmethod
+    def _isUpstreamRepo() -> bool:
+        """True if CIRCUITPYTHON_REPO_URL is the repo the PyPI stubs are released from, not a fork."""
+        def normalize(url: str) -> str:
+            return url.strip().rstrip("/").removesuffix(".git").lower()
+        return normalize(StubsConfig.CIRCUITPYTHON_REPO_URL) == normalize(_UPSTREAM_REPO_URL)
+
+    def _stubsUpToDate(self) -> bool:
+        """
+        True if the clone is at the requested version and the stubs are for it.
+        With BUILD_FROM_SOURCE, stubs downloaded from PyPI don't count.
+        """
+        if not self.circuitpython_dir.exists() or not self.stubs_version_file.exists():
+            return False
+        # Files written before the origin was recorded only held the commit of a source build
+        commit, _, origin = self.stubs_version_file.read_text().strip().partition(" ")
+        if StubsConfig.BUILD_FROM_SOURCE and origin not in ("", "source"):
+            return False
+        head = self._revParse("HEAD")
+        return (head is not None
+                and head == self._revParse(f"{self.version}^{{commit}}")
+                and head == commit)
+
+    def _revParse(self, rev: str) -> Optional[str]:
+        """Resolve rev to a commit SHA in the circuitpython clone, None if it is unknown."""
+        if not self.circuitpython_dir.exists():
+            return None
+        result = self.run_command(["git", "rev-parse", "--verify", "--quiet", rev], cwd=self.circuitpython_dir,
+                                  capture_output=True, check=False)
+        return result.stdout.strip() if result.returncode == 0 else None
 
     @stubTarget( inCP=False)
     def checkVersions(self):
         print("CHECKING VERSIONS...")
-        versionRegx = re.compile(r"^(?:\w+\s+)?(?:v)?(\d+)\.(\d+)\.(\d+)$")
-        def extractVersion( version:str) -> tuple[int, int, int]:
-            match = versionRegx.match(version)
+        def extractVersion( version:str) -> Version|tuple[int, int, int]:
+            match = _VERSION_RE.match(version)
             if not match:
                 raise ValueError(f"Invalid version string: {version}")
-            return tuple(map(int, match.groups()))  
+            if Version is not None:
+                # handles pre/post releases, e.g. "Python 3.13.0rc1"
+                return Version(match.group("version"))
+            return tuple(map(int, match.groups()[1:]))
         
-        def checkVersion( cmd, minVersion:str|type[tuple[int, int, int]]):
+        def checkVersion( cmd:list[str], minVersion:str|Version|tuple[int, int, int]):
             if isinstance(minVersion, str): 
                 minVersion = extractVersion(minVersion)
-            version = self.run_command(cmd,capture_output=True).stdout.strip()
+            version = self.run_command(cmd, cwd=self.repo_root, capture_output=True).stdout.strip()
             print(f"version ({type(version)}) = {repr(version)}")
             current = extractVersion(version)
             if current < minVersion:
-                logging.error(f"Version check failed: {cmd} {current} < {minVersion}")
+                logging.error(f"Version check failed: {shlex.join(cmd)} {current} < {minVersion}")
                 sys.exit(1)
 
-        checkVersion(StubsConfig.PYTHON_COMMAND + " --version", "3.11.0")
-        checkVersion("node --version", "22.18.0")
-        checkVersion("npm --version", "10.9.3")
+        checkVersion([*self.python_command, "--version"], "3.11.0")
+        checkVersion(["node", "--version"], "22.18.0")
+        checkVersion(["npm", "--version"], "10.9.3")
 
 
     @stubTarget( inCP=False)
     def cloneRepo(self): # Clone repository if it doesn't exist
+        just_cloned = False
         if not self.circuitpython_dir.exists():
-            os.chdir(self.repo_root)
-            self.run_command(f"git clone {StubsConfig.CIRCUITPYTHON_REPO_URL} {self.circuitpython_dir}")
-            os.chdir(self.circuitpython_dir)
-            
-        # Change to circuitpython directory
-        os.chdir(self.circuitpython_dir)
+            if StubsConfig.USE_MIRROR:
+                self._updateMirror()
+                # Forget worktrees whose directory was deleted by hand
+                self.run_command(["git", "worktree", "prune"], cwd=self.mirror_dir)
+                self.run_command(["git", "worktree", "add", "--detach", str(self.circuitpython_dir), self.version],
+                                 cwd=self.mirror_dir, timeout=self.network_timeout)
+            else:
+                # Some tools do not cope with missing blobs, so this is opt-in
+                clone_options = ["--filter=blob:none"] if StubsConfig.PARTIAL else []
+                if not StubsConfig.FULL_HISTORY:
+                    # Only the requested tag is needed to build the stubs
+                    clone_options += ["--depth", "1", "--branch", self.version, "--single-branch"]
+                self.run_command([*self.git_network_command, "clone", *clone_options,
+                                  StubsConfig.CIRCUITPYTHON_REPO_URL, str(self.circuitpython_dir)],
+                                 cwd=self.repo_root, timeout=self.network_timeout)
+            just_cloned = True
+
+        # Fetch submodules in parallel, the git submodule calls made by
+        # fetch-all-submodules pick this up from the clone's config
+        self.run_command(["git", "config", "submodule.fetchJobs", str(os.cpu_count() or 8)],
+                         cwd=self.circuitpython_dir)
+
+        # Checkout specific version (a fresh clone is already there)
+        if not just_cloned:
+            # Only go to the network when the tag is not there yet
+            if self._revParse(f"{self.version}^{{commit}}") is None:
+                if self._isMirrorWorktree():
+                    # The worktree shares the mirror's tags
+                    self._updateMirror()
+                elif self.run_command(["git", "rev-parse", "--is-shallow-repository"], cwd=self.circuitpython_dir,
+                                      capture_output=True).stdout.strip() == "true":
+                    # A shallow clone only has the tags it was cloned at or fetched
+                    self.run_command([*self.git_network_command, "fetch", "--depth", "1", "origin", "tag",
+                                      self.version], cwd=self.circuitpython_dir, timeout=self.network_timeout)
+            self.run_command(["git", "checkout", self.version], cwd=self.circuitpython_dir)
+
+    def _updateMirror(self) -> None:
+        """Create the bare mirror, or fetch new tags into it, so only new objects are downloaded."""
+        if not self.mirror_dir.exists():
+            self.mirror_dir.parent.mkdir(parents=True, exist_ok=True)
+            # Blobs are fetched when a worktree checks them out
+            self.run_command([*self.git_network_command, "clone", "--bare", "--filter=blob:none",
+                              StubsConfig.CIRCUITPYTHON_REPO_URL, str(self.mirror_dir)],
+                             cwd=self.mirror_dir.parent, timeout=self.network_timeout)
+        else:
+            self.run_command([*self.git_network_command, "fetch", "--tags", "origin"],
+                             cwd=self.mirror_dir, timeout=self.network_timeout)
+
+    def _isMirrorWorktree(self) -> bool:
+        """True if circuitpython_dir is a worktree of the mirror rather than a clone of its own."""
+        # A worktree's .git is a file pointing into the mirror
+        return (self.circuitpython_dir / ".git").is_file() and self.mirror_dir.exists()
+
+    @stubTarget(inCP=False, unique=True)
+    def removeRepo(self):
+        print("REMOVING CIRCUITPYTHON...")
+        if self._isMirrorWorktree():
+            self.run_command(["git", "worktree", "remove", "--force", str(self.circuitpython_dir)],
+                             cwd=self.mirror_dir)
+        elif self.circuitpython_dir.exists():
+            safe_rmtree(self.circuitpython_dir)
+
+    @stubTarget(inCP=False, unique=True)
+    def fetchStubs(self):
+        if not self._fetchStubs():
+            logging.error(f"Could not download circuitpython-stubs {self.version}, build them from source instead")
+            sys.exit(1)
+
+    def _fetchStubs(self) -> bool:
+        """Download the released circuitpython-stubs wheel into stubs_dir, False if that fails."""
+        print("DOWNLOADING STUBS...")
+        # Next to stubs_dir, so the unpacked stubs can be renamed into place
+        with tempfile.TemporaryDirectory(dir=self.repo_root, prefix=".stubs-") as tmp:
+            download_dir = Path(tmp) / "download"
+            result = self.run_command([*self.python_command, "-m", "pip", "download", "--disable-pip-version-check",
+                                       "--no-deps", "--only-binary", ":all:", "--dest", str(download_dir),
+                                       f"circuitpython-stubs=={self.version}"],
+                                      cwd=self.repo_root, check=False, timeout=self.network_timeout)
+            wheels = list(download_dir.glob("*.whl")) if result.returncode == 0 else []
+            if not wheels:
+                logging.warning(f"circuitpython-stubs {self.version} is not available from PyPI")
+                return False
+            try:
+                unpacked = Path(tmp) / "stubs"
+                extract_stubs_wheel(wheels[0], unpacked)
+                self._replaceStubs(unpacked)
+            except (OSError, zipfile.BadZipFile) as e:
+                logging.warning(f"Could not unpack {wheels[0].name}: {e}")
+                return False
+        self._writeStubsVersion("pypi")
+        return True
+
+    def _unpackCachedStubs(self) -> bool:
+        """Unpack the make stubs output cached for the checkout into stubs_dir, False if there is none."""
+        cache = self._stubsCache()
+        if cache is None or not cache.exists():
+            return False
+        print(f"Using cached stubs {cache}")
+        with tempfile.TemporaryDirectory(dir=self.repo_root, prefix=".stubs-") as tmp:
+            try:
+                with tarfile.open(cache) as tar:
+                    tar.extractall(tmp, **self._tarfileFilter())
+                self._replaceStubs(Path(tmp) / self.circuitpython_stubs.name)
+            except (OSError, tarfile.TarError) as e:
+                logging.warning(f"Could not unpack {cache}: {e}")
+                return False
+        self._writeStubsVersion("source")
+        return True
+
+    def _replaceStubs(self, stubs: Path) -> None:
+        """Replace stubs_dir with the stubs directory, which is on the same filesystem."""
+        if self.stubs_dir.exists():
+            safe_rmtree(self.stubs_dir)
+        os.rename(stubs, self.stubs_dir)
 
-        # Checkout specific version and fetch submodules
-        self.run_command(f"git checkout {self.version}")
-        self.run_command("make fetch-all-submodules")
+    @stubTarget(concurrent=True, fromSource=True)
+    def fetchSubmodules(self):
+        # The venv only needs the requirements files from the checkout, so
+        # all sets it up while this runs
+        self.run_command(["make", "fetch-all-submodules"], cwd=self.circuitpython_dir,
+                         timeout=self.network_timeout)
 
     @stubTarget()
     def setupVenv(self):
+        # uv creates the venv and installs into it much faster than venv and pip
+        uv = shutil.which("uv")
+
         # Setup virtual environment
         if not os.path.exists(self.venv_dir):
-            self.run_command(f"{StubsConfig.PYTHON_COMMAND} -m venv {self.venv_dir}")
+            if uv and len(self.python_command) == 1:
+                # --seed adds pip, so the venv still works without uv
+                self.run_command([uv, "venv", "--seed", "--python", self.python_command[0], str(self.venv_dir)],
+                                 cwd=self.circuitpython_dir, timeout=self.network_timeout)
+            else:
+                self.run_command([*self.python_command, "-m", "venv", str(self.venv_dir)], cwd=self.circuitpython_dir)
 
         # Activate virtual environment (Python way)
         assert os.path.exists(self.venv_dir), f"Virtual environment directory {self.venv_dir} does not exist."
         self._setupVenvCmds()
         
-        # Install dependencies
-        self.run_python("-m pip install --upgrade pip wheel")
-        self.run_pip(f"install --upgrade pip wheel")
-        self.run_pip(f"install bs4")
-        self.run_pip(f"install -r requirements-doc.txt")
-        self.run_pip(f"install -r requirements-dev.txt")
-        self.run_pip(f"install -r {self.circuitpython_dir}/requirements-doc.txt")
-
-    @stubTarget()
+        # Install dependencies, unless they are unchanged since the last install
+        reqs_sha = self._requirementsHash()
+        if self.venv_reqs_file.exists() and self.venv_reqs_file.read_text().strip() == reqs_sha:
+            print("Virtual environment is up to date")
+            return
+        requirements = [arg for name in _VENV_REQUIREMENTS for arg in ("-r", str(self.circuitpython_dir / name))]
+        if uv:
+            self.run_command([uv, "pip", "install", "--python", str(self.venv_python), "bs4", *requirements],
+                             cwd=self.circuitpython_dir, timeout=self.network_timeout)
+        else:
+            # Upgrade pip first, then resolve everything else in a single pip run
+            pip_options = ["--disable-pip-version-check", "--no-compile"]
+            self.run_python(["-m", "pip", "install", *pip_options, "--upgrade", "pip", "wheel"],
+                            cwd=self.circuitpython_dir, timeout=self.network_timeout)
+            self.run_pip(["install", *pip_options, "bs4", *requirements],
+                         cwd=self.circuitpython_dir, timeout=self.network_timeout)
+        self.venv_reqs_file.write_text(f"{reqs_sha}\n")
+
+    def _requirementsHash(self) -> str:
+        """Hash the circuitpython requirements files the venv is installed from."""
+        digest = hashlib.sha256()
+        for name in _VENV_REQUIREMENTS:
+            digest.update((self.circuitpython_dir / name).read_bytes())
+        return digest.hexdigest()
+
+    @stubTarget(fromSource=True)
     def makeStubs(self):
         print("GENERATING STUBS...")
+        cache = self._stubsCache()
+        if cache and cache.exists() and not StubsConfig.FORCE:
+            print(f"Using cached stubs {cache}")
+            if self.circuitpython_stubs.exists():
+                safe_rmtree(self.circuitpython_stubs)
+            with tarfile.open(cache) as tar:
+                tar.extractall(self.circuitpython_dir, **self._tarfileFilter())
+            return
+
         # Generate stubs
-        self.run_command(f"make  PYTHON={self.venv_python} stubs")
+        self.run_command(["make", f"PYTHON={self.venv_python}", "stubs"], cwd=self.circuitpython_dir)
+        if cache:
+            self._cacheStubs(cache)
 
-    @stubTarget()
+    def _stubsCache(self) -> Optional[Path]:
+        """
+        Cache archive for the make stubs output of the checkout. The stubs only
+        depend on the source tree (submodule commits included), so it is keyed by
+        the tree hash. None when there is no checkout.
+        """
+        tree = self._revParse("HEAD^{tree}")
+        return CACHE_DIR / f"stubs-{tree}.tar.gz" if tree else None
+
+    def _cacheStubs(self, cache: Path) -> None:
+        """Pack circuitpython-stubs into the cache, a failure only costs the next build."""
+        partial = cache.with_name(f"{cache.name}.{os.getpid()}.tmp")
+        try:
+            cache.parent.mkdir(parents=True, exist_ok=True)
+            with tarfile.open(partial, "w:gz", compresslevel=6) as tar:
+                tar.add(self.circuitpython_stubs, arcname=self.circuitpython_stubs.name)
+            # readers never see a partly written archive
+            os.replace(partial, cache)
+        except OSError as e:
+            logging.warning(f"Could not cache stubs in {cache}: {e}")
+            partial.unlink(missing_ok=True)
+
+    @staticmethod
+    def _tarfileFilter() -> dict[str, Any]:
+        """extractall arguments refusing links and paths outside the destination, where tarfile supports it."""
+        return {"filter": "data"} if hasattr(tarfile, "data_filter") else {}
+
+    @stubTarget(fromSource=True)
     def copyStubs(self):
 
         print("COPYING STUBS...")
+        # The generated stubs are moved, so they are gone after a previous run
+        if not self.circuitpython_stubs.is_dir():
+            logging.error(f"No generated stubs in {self.circuitpython_stubs}, run makeStubs first")
+            sys.exit(1)
+
         # Handle stubs directory
         if self.stubs_dir.exists():
             safe_rmtree(self.stubs_dir)
-        self.stubs_dir.mkdir(parents=True)
 
-        # Move generated stubs
+        # Move generated stubs, make stubs regenerates them when needed.
         try:
-            for item in self.circuitpython_stubs.glob("*"):
-                if item.is_file():
-                    shutil.copy2(item, self.stubs_dir)
-                else:
-                    shutil.copytree(item, self.stubs_dir / item.name)
+            try:
+                # On the same filesystem the whole tree moves with one rename
+                os.rename(self.circuitpython_stubs, self.stubs_dir)
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    raise
+                # Each entry is independent, so when they have to be copied across
+                # filesystems the copies overlap instead of running one by one.
+                self.stubs_dir.mkdir(parents=True)
+                with ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 4) * 4)) as executor, \
+                        os.scandir(self.circuitpython_stubs) as entries:
+                    # list() re-raises the first failure
+                    list(executor.map(lambda entry: move_or_copy(entry, self.stubs_dir / entry.name), entries))
+                safe_rmtree(self.circuitpython_stubs)
         except OSError as e:
             logging.error(f"Error copying stubs: {e}")
             sys.exit(1)
+        self._writeStubsVersion("source")
 
-    @stubTarget()
+    def _writeStubsVersion(self, origin: str) -> None:
+        """Record the circuitpython commit the stubs in stubs_dir are for and their origin."""
+        head = self._revParse("HEAD")
+        if head is None:
+            # e.g. fetchStubs without a checkout, the stubs aren't tied to a commit
+            self.stubs_version_file.unlink(missing_ok=True)
+            return
+        self.stubs_version_file.write_text(f"{head} {origin}\n")
+
+    @stubTarget( inCP=False)
     def buildBoards(self):
         print("BUILDING BOARDS...")
-        # Change back to repo root and build stubs
-        os.chdir(self.repo_root)
-        self.run_python(f"./scripts/build-boards.py")
+        self.run_python(["./scripts/build-boards.py", "--circuitpython_dir", str(self.circuitpython_dir)],
+                        cwd=self.repo_root)
 
     @stubTarget(unique=True)
     def cleanup(self):
@@ -208,28 +597,93 @@ class StubGenerator:
             self.venv_pip = self.venv_dir / "scripts" / "pip"
             self.venv_python = self.venv_dir / "scripts" / "python"
 
-    def run_pip(self, cmd ):
-        return self.run_command( f"{self.venv_pip} {cmd}" )
+    @property
+    def python_command(self) -> list[str]:
+        """StubsConfig.PYTHON_COMMAND as argv, it may carry options (e.g. "py -3.12")"""
+        return shlex.split(StubsConfig.PYTHON_COMMAND, posix=os.name != "nt")
+
+    def run_pip(self, args: list[str], **kwargs):
+        return self.run_command([str(self.venv_pip), *args], **kwargs)
 
-    def run_python(self, cmd):
-        return self.run_command(f"{self.venv_python} {cmd}")
+    def run_python(self, args: list[str], **kwargs):
+        return self.run_command([str(self.venv_python), *args], **kwargs)
 
-    def run_command(self, cmd: str, cwd: Optional[Path] = None, capture_output: bool = False) -> subprocess.CompletedProcess:
+    def run_command(self, cmd: list[str], cwd: Optional[Path] = None, capture_output: bool = False,
+                    check: bool = True, timeout: Optional[float] = None) -> subprocess.CompletedProcess:
         """
-        Execute a shell command and handle errors.
+        Execute a command and handle errors.
         
         Args:
-            cmd: Command to execute
+            cmd: Program and arguments to execute, run without a shell
             cwd: Working directory for command execution
+            check: Exit if the command fails, otherwise return its result
+            timeout: Seconds before the command is considered hung and stopped
         Raises:
-            SystemExit: If command execution fails
+            SystemExit: If command execution fails or times out
         """
-        logging.debug(f"Executing: {cmd} in {cwd or 'current directory'}")
+        logging.debug(f"Executing: {shlex.join(cmd)} in {cwd or 'current directory'}")
+        # Resolve the program on PATH so Windows .cmd shims (npm) run without a shell
+        args = [shutil.which(cmd[0]) or cmd[0], *cmd[1:]]
+        pipe = subprocess.PIPE if capture_output else None
+        with self._processes_lock:
+            if self._stopping:
+                sys.exit(1)
+            try:
+                # Own process group on POSIX, so stopping e.g. make also stops the git it runs
+                group = {"process_group": 0} if os.name == "posix" else {}
+                process = subprocess.Popen(args, cwd=cwd, stdout=pipe, stderr=pipe, text=True, **group)
+            except FileNotFoundError as e:
+                logging.error(f"Command not found: {cmd[0]}: {e}")
+                sys.exit(1)
+            self._processes.add(process)
         try:
-            return subprocess.run(cmd, cwd=cwd, check=True, shell=True,capture_output=capture_output,text=True,  )
-        except subprocess.CalledProcessError as e:
-            logging.error(f"Error executing {cmd}: {e}")
+            stdout, stderr = process.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            self._terminate(process)
+            logging.error(f"Timed out after {timeout}s: {shlex.join(cmd)}")
+            sys.exit(1)
+        except KeyboardInterrupt:
+            # Don't leave e.g. a git fetch running after Ctrl-C
+            self._terminate(process)
+            raise
+        finally:
+            with self._processes_lock:
+                self._processes.discard(process)
+        if check and process.returncode != 0:
+            logging.error(f"Error executing {shlex.join(cmd)}: exit status {process.returncode}")
             sys.exit(1)
+        return subprocess.CompletedProcess(args, process.returncode, stdout, stderr)
+
+    @staticmethod
+    def _terminate(process: subprocess.Popen) -> None:
+        """Stop process and its children, killing them if they don't exit shortly after SIGTERM."""
+        def stop(kill: bool) -> None:
+            if process.poll() is not None:
+                return
+            if os.name != "posix":
+                process.kill() if kill else process.terminate()
+                return
+            try:
+                os.killpg(process.pid, signal.SIGKILL if kill else signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        stop(kill=False)
+        try:
+            process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            stop(kill=True)
+            process.wait()
+
+    @property
+    def git_network_command(self) -> list[str]:
+        """git tuned for clone/fetch: index-pack and fetch on all CPUs, protocol v2 for a smaller ref advertisement"""
+        return ["git", "-c", "pack.threads=0", "-c", "core.deltaBaseCacheLimit=2g",
+                "-c", f"fetch.parallel={os.cpu_count() or 8}", "-c", "protocol.version=2"]
+
+    @property
+    def network_timeout(self) -> Optional[float]:
+        """StubsConfig.NETWORK_TIMEOUT in seconds, None when disabled"""
+        return float(StubsConfig.NETWORK_TIMEOUT) or None
                     
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Generate and manage CircuitPython stubs.")
@@ -245,13 +699,16 @@ if __name__ == "__main__":
 
         envVal = os.getenv(tag, None)
         if envVal is not None:
-            setattr(StubsConfig, tag, type(val)(envVal))
-            
+            # bool("0") is True, so flags are parsed by hand
+            setattr(StubsConfig, tag, envVal.lower() in ("1", "true", "yes") if isinstance(val, bool) else type(val)(envVal))
+
+        # The environment value is the default, the command line overrides it
+        default = getattr(StubsConfig, tag)
         if isinstance(val,bool):
-            parser.add_argument(f"--{tag.lower()}", action='store_true', default=val,)
+            parser.add_argument(f"--{tag.lower()}", action='store_true', default=default,)
         else:
             assert isinstance(val, str), f"Unexpected type {type(val)} for {tag}"
-            parser.add_argument(f"--{tag.lower()}", default=val)
+            parser.add_argument(f"--{tag.lower()}", default=default)
 
     args = parser.parse_args()
     for tag,val in StubsConfig.__dict__.items():